@@ -19,6 +19,17 @@
 # FORCE_UPDATE can also be set to True from False to force updates, useful in a 
 # situation where the XSLT transform changes, etc.
 
+# records withdrawn from geonetwork show up in the OAI-PMH ListIdentifiers
+# response as headers with status="deleted"; the packages for these are
+# archived on the GMN each run. RECONCILE can be set to True from False to
+# also archive every GMN package whose fileID is no longer in the catalog at
+# all, e.g. after the OAI-PMH server has purged its deleted records. This is a
+# full comparison against the catalog, so it is meant to be run periodically.
+# it assumes the GMN holds only geo2d1 packages: any resource map named
+# <fileID>_<index> whose dcx_ and iso19139_ objects exist is taken as one.
+# if an archived record later comes back live, archived objects can not be
+# updated or unarchived, so a new package is created at the next index.
+
 # requires python version < 2.7.9 if the GMN has no/invalid site certificate.
 
 
@@ -54,11 +65,12 @@
 
 # stdlib
 #import logging
+import cStringIO
 import hashlib
 import lxml.etree as et
 import os
-import StringIO
 
+from collections import namedtuple
 from datetime import datetime
 from sys import argv
 from time import sleep
@@ -77,6 +89,7 @@ import d1_common.types.exceptions
 GEO_URL  = 'http://climate.iarc.uaf.edu/geonetwork/srv/en/main.home/oaipmh'
 GMN_URL  = 'https://trusty.iarc.uaf.edu/mn'
 FORCE_UPDATE = False
+RECONCILE    = False
 CERTIFICATE_FOR_CREATE      = '/home/jlong/d1/keys/jl_cert.pem'
 CERTIFICATE_FOR_CREATE_KEY  = '/home/jlong/d1/keys/jl_key.pem'
 SYSMETA_RIGHTSHOLDER        = 'CN=jlong,O=International Arctic Research Center,ST=AK,C=US'
@@ -87,6 +100,18 @@ DATA_FORMAT_ID = 'text/xml'
 META_FORMAT_ID = 'http://ns.dataone.org/metadata/schema/onedcx/v1.0'
 RMAP_FORMAT_ID = 'http://www.openarchives.org/ore/terms'
 
+# xml declarations prepended to the serialized dcx and ISO 19139 payloads.
+# these must stay byte-for-byte identical to what is already on the GMN,
+# otherwise every ISO 19139 data object compares as changed.
+DCX_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+ISO_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# indentation left on the ISO 19139 record by the OAI-PMH GetRecord wrapper
+ISO_WRAPPER_INDENT = "\n        "
+
+# an object ready for upload: the serialized bytes, their size and SHA-1 digest
+Payload = namedtuple('Payload', 'data size sha1')
+
 def main():
   #logging.basicConfig()
   #logging.getLogger('').setLevel(logging.DEBUG)
@@ -114,7 +139,7 @@ def main():
     return
   else:
     root    = et.fromstring(xmlDoc)
-    fileIDs = [ i.text for i in root.findall("./{http://www.openarchives.org/OAI/2.0/}ListIdentifiers/{http://www.openarchives.org/OAI/2.0/}header/{http://www.openarchives.org/OAI/2.0/}identifier") ]
+    fileIDs, deletedIDs = split_headers(root)
     rt      = root.findall("./{http://www.openarchives.org/OAI/2.0/}ListIdentifiers/{http://www.openarchives.org/OAI/2.0/}resumptionToken")
 
   print "downloading..."
@@ -138,12 +163,16 @@ def main():
       return
     else:
       root    = et.fromstring(xmlDoc)
-      fileIDs = fileIDs + [ i.text for i in root.findall("./{http://www.openarchives.org/OAI/2.0/}ListIdentifiers/{http://www.openarchives.org/OAI/2.0/}header/{http://www.openarchives.org/OAI/2.0/}identifier") ]
+      live, deleted = split_headers(root)
+      fileIDs    = fileIDs + live
+      deletedIDs = deletedIDs + deleted
       print "downloading..."
       rt      = root.findall("./{http://www.openarchives.org/OAI/2.0/}ListIdentifiers/{http://www.openarchives.org/OAI/2.0/}resumptionToken")
 
-  # uniq the list
-  fileIDs = list(set(fileIDs))
+  # uniq the lists; an identifier seen both live and deleted (the record
+  # changed during the harvest) is treated as live
+  fileIDs    = list(set(fileIDs))
+  deletedIDs = list(set(deletedIDs) - set(fileIDs))
   
   if len(argv) > 1 and int(argv[1]) > len(fileIDs):
     print "the argument " + argv[1] + " is larger than the number of records, " + str(len(fileIDs)) + ","
@@ -151,6 +180,7 @@ def main():
     return
   
   print "number of unique Identifiers = ", len(fileIDs)
+  print "number of deleted Identifiers = ", len(deletedIDs)
 
   # xsl doc to xslt transform OAI-PMH ISO 19139 record to dcx
   # test this on the command line by saving it in file 'test.xsl', and running
@@ -297,6 +327,19 @@ def main():
     print "unable to generate transform, exiting..."
     return
 
+  # dcx schema, assumes onedcx_v1.0.xsd and associated xsd
+  # files are in same directory where this script is run:
+  # dcmitype.xsd
+  # dcterms.xsd <--- original, not LoC version
+  # dc.xsd
+  # onedcx_v1.0.xsd
+  # xml.xsd
+  try:
+    dcxXsd = et.XMLSchema(et.parse("onedcx_v1.0.xsd"))
+  except:
+    print "unable to load dcx schema onedcx_v1.0.xsd, exiting..."
+    return
+
   print ""
 
   # client to interact with GMN
@@ -321,8 +364,26 @@ def main():
     print "listObjects() failed with exception:"
     raise
 
-  # generate a list of pid strings
-  objStrings = [ obj.identifier.value() for obj in objs.objectInfo ]
+  # generate a set of resource map pid strings
+  objStrings = set([ obj.identifier.value() for obj in objs.objectInfo ])
+
+  # archive packages of records deleted from geonetwork and, when reconciling,
+  # packages of records no longer in the catalog
+  archiveIDs = set(deletedIDs)
+  if RECONCILE:
+    if len(fileIDs)==0:
+      print "no live Identifiers from " + GEO_URL + ", skipping reconciliation..."
+    else:
+      gmnIDs = set([ pid.rsplit("_", 1)[0] for pid in objStrings
+                     if "_" in pid and pid.rsplit("_", 1)[1].isdigit() ])
+      orphans = gmnIDs - set(fileIDs) - archiveIDs
+      print "reconciliation found " + str(len(orphans)) + " packages no longer in the catalog"
+      archiveIDs |= orphans
+
+  if archiveIDs:
+    sleep(0.1)
+    archivePackages(archiveIDs, objStrings, client)
+    print ""
 
   # for each fileID, get the latest resource map
   sleep(0.1)
@@ -349,25 +410,17 @@ def main():
       isoDoc = et.parse(fo)
 
       dcxDoc = transform(isoDoc)
-      dcxString = et.tostring(dcxDoc)
-      dcxString = '<?xml version="1.0" encoding="UTF-8"?>' + dcxString
-      #print dcxString
-
-      # validate dcxDoc, assumes onedcx_v1.0.xsd and associated xsd
-      # files are in same directory where this script is run:
-      # dcmitype.xsd
-      # dcterms.xsd <--- original, not LoC version
-      # dc.xsd
-      # onedcx_v1.0.xsd
-      # xml.xsd
-
-      dcxXsd = et.XMLSchema(et.parse("onedcx_v1.0.xsd"))
+
+      # validate dcxDoc against the dcx schema loaded above
       if dcxXsd.validate(dcxDoc):
+        dcx = serialize_payload(dcxDoc, DCX_DECLARATION)
+        #print dcx.data
 
         # extract original ISO metadata from OAI-PMH wrapper to upload as data
-        isoXML = et.tostring(isoDoc.find("//{http://www.isotc211.org/2005/gmd}MD_Metadata"))
-        isoXML = '<?xml version="1.0" encoding="UTF-8"?>\n' + isoXML.replace("\n        ","\n")
-        #print isoXML
+        isoMD = isoDoc.find("//{http://www.isotc211.org/2005/gmd}MD_Metadata")
+        strip_indent(isoMD, ISO_WRAPPER_INDENT)
+        iso = serialize_payload(isoMD, ISO_DECLARATION)
+        #print iso.data
 
         # the package will consist of dcx metadata, with pid
         # "dcx_" + fileID + "_" + version
@@ -383,45 +436,51 @@ def main():
 
         # the whole reason to walk the chain is to get the latest index (idx),
         # so that an update can have idx = idx + 1
-        idx = 0
-        packageJustCreated = 0
-        while True:
-          rmap = fileID + "_" + str(idx)
-
-          if rmap in objStrings:
-            idx += 1
-            continue
+        idx = latest_index(fileID, objStrings)
+
+        if idx < 0: # initial package creation
+          idx = 0
+          sleep(0.1)
+          if not createInitialPackage(dcx, iso, fileID, idx, client):
+            print "package creation failure for " + fileID + "_" + str(idx)
+            print "halting; either there is a network problem (try running this script again),"
+            print "and/or the package already exists (please investigate)..."
+            return
           else:
-            if idx==0: # initial package creation
-              sleep(0.1)
-              if not createInitialPackage(dcxString, isoXML, fileID, client):
-                print "package creation failure for " + fileID + "_" + str(idx)
-                print "halting; either there is a network problem (try running this script again),"
-                print "and/or the package already exists (please investigate)..."
-                return
-              else:
-                packageJustCreated = 1
-                sleep(0.1)
-                break
-            else:
-              idx -= 1
-              break
+            sleep(0.1)
 
-        # check if update required: get the latest ISO 19139 data object, compare
-        # with downloaded OAI-PMH version, and update package if different
-        if not packageJustCreated:
+        # check if update required: get the system metadata of the latest ISO 19139
+        # data object, compare its checksum with that of the downloaded OAI-PMH
+        # version, and update package if different
+        else:
           sleep(0.1)
           try:
-            isoDO = client.get("iso19139_" + fileID + "_" + str(idx)).read()
+            isoSysMeta = client.getSystemMetadata("iso19139_" + fileID + "_" + str(idx))
           except:
             print "ISO metadata retrieval error for iso19139_" + fileID + "_" + str(idx)
             print "halting; probably a network problem (try running this script again)."
             return
           else:
-            if isoDO != isoXML:
+            # a package archived because its record was withdrawn, and whose
+            # record is live again, can not be updated (GMN rejects updates to
+            # archived objects) nor unarchived, so a new package is created at
+            # the next index instead; the archived objects are left as they are.
+            # archivePackages archives the ISO 19139 object first, so if it is
+            # not archived, no other object of the package is either
+            if isoSysMeta.archived:
+              print "package " + fileID + "_" + str(idx) + " is archived but the record is live again,"
+              print "creating a new package, new index is " + "_" + str(idx+1)
+              sleep(0.1)
+              if not createInitialPackage(dcx, iso, fileID, idx+1, client):
+                print "package creation failure for " + fileID + "_" + str(idx+1)
+                print "halting; either there is a network problem (try running this script again),"
+                print "and/or the package already exists (please investigate)..."
+                return
+              sleep(0.1)
+            elif isoSysMeta.checksum.value().lower() != iso.sha1:
               print "changes in " + "iso19139_" + fileID + "_" + str(idx) + " detected,"
               print "updating package, new index is " +  "_" + str(idx+1)
-              if not updatePackage(dcxString, isoXML, fileID, idx, client):
+              if not updatePackage(dcx, iso, fileID, idx, client):
                 print "package update failure for " + fileID + "_" + str(idx)
                 print "halting; either there is a network problem (try running this script again),"
                 print "and/or the package already exists (please investigate)..."
@@ -429,7 +488,7 @@ def main():
             elif FORCE_UPDATE:
               print "update forced for " + "iso19139_" + fileID + "_" + str(idx)
               print "new index is " +  "_" + str(idx+1)
-              if not updatePackage(dcxString, isoXML, fileID, idx, client):
+              if not updatePackage(dcx, iso, fileID, idx, client):
                 print "package update failure for " + fileID + "_" + str(idx)
                 print "halting; either there is a network problem (try running this script again),"
                 print "and/or the package already exists (please investigate)..."
@@ -447,43 +506,43 @@ def main():
   return
 ## end main()
 
-def createInitialPackage(dcxString, isoXML, fileID, client):
+def createInitialPackage(dcx, iso, fileID, idx, client):
   now = datetime.now()
 
   # create metadata object
   pids = ["dcx_" + fileID]
-  print "creating metadata object " + pids[0] + "_0"
+  print "creating metadata object " + pids[0] + "_" + str(idx)
   sysMeta = create_sys_meta(
               pids[0],
               META_FORMAT_ID,
-              0,
-              len(dcxString),
-              dataoneTypes.checksum(hashlib.sha1(dcxString).hexdigest()),
+              idx,
+              dcx.size,
+              dataoneTypes.checksum(dcx.sha1),
               now)
-  pids[0] = pids[0] + "_0"
+  pids[0] = pids[0] + "_" + str(idx)
 
   try:
     sleep(0.1)
-    client.create(pids[0], StringIO.StringIO(dcxString), sysMeta)
+    client.create(pids[0], cStringIO.StringIO(dcx.data), sysMeta)
   except:
     print "creation of metadata object " + pids[0] + " failed"
     return False
 
   # create data object, the ISO 19139 metadata xml
   pids = pids + ["iso19139_" + fileID]
-  print "creating data object " + pids[-1] + "_0"
+  print "creating data object " + pids[-1] + "_" + str(idx)
   sysMeta = create_sys_meta(
               pids[-1],
               DATA_FORMAT_ID,
-              0,
-              len(isoXML),
-              dataoneTypes.checksum(hashlib.sha1(isoXML).hexdigest()),
+              idx,
+              iso.size,
+              dataoneTypes.checksum(iso.sha1),
               now)
-  pids[-1] = pids[-1] + "_0"
+  pids[-1] = pids[-1] + "_" + str(idx)
 
   try:
     sleep(0.1)
-    client.create(pids[-1], StringIO.StringIO(isoXML), sysMeta)
+    client.create(pids[-1], cStringIO.StringIO(iso.data), sysMeta)
   except:
     print "creation of data object " + pids[-1] + " failed"
     print "rolling back..."
@@ -505,21 +564,21 @@ def createInitialPackage(dcxString, isoXML, fileID, client):
     return False
 
   # create resource map
-  pid = fileID + "_0"
+  pid = fileID + "_" + str(idx)
   print "creating resource map " + pid
   rmapGenerator = d1_client.data_package.ResourceMapGenerator()
-  rmap = rmapGenerator.simple_generate_resource_map(pid, pids[0], pids[1:])
+  rmap = make_payload(rmapGenerator.simple_generate_resource_map(pid, pids[0], pids[1:]))
   sysMeta = create_sys_meta(
               fileID,
               RMAP_FORMAT_ID,
-              0,
-              len(rmap),
-              dataoneTypes.checksum(hashlib.sha1(rmap).hexdigest()),
+              idx,
+              rmap.size,
+              dataoneTypes.checksum(rmap.sha1),
               now)
 
   try:
     sleep(0.1)
-    client.create(pid, StringIO.StringIO(rmap), sysMeta)
+    client.create(pid, cStringIO.StringIO(rmap.data), sysMeta)
   except:
     print "creation of resource map " + pid + " failed"
     print "rolling back..."
@@ -561,6 +620,110 @@ def createInitialPackage(dcxString, isoXML, fileID, client):
   return True
 
 
+def split_headers(root):
+  # split the headers of an OAI-PMH ListIdentifiers response into live and
+  # deleted identifiers
+  live    = []
+  deleted = []
+  for header in root.findall("./{http://www.openarchives.org/OAI/2.0/}ListIdentifiers/{http://www.openarchives.org/OAI/2.0/}header"):
+    fileID = header.findtext("{http://www.openarchives.org/OAI/2.0/}identifier")
+    if header.get("status") == "deleted":
+      deleted.append(fileID)
+    else:
+      live.append(fileID)
+
+  return live, deleted
+
+
+def latest_index(fileID, objStrings):
+  # walk the resource map chain fileID_0, fileID_1, ... in objStrings,
+  # returning the index of the most recent version, or -1 if there is none
+  idx = 0
+  while fileID + "_" + str(idx) in objStrings:
+    idx += 1
+
+  return idx - 1
+
+
+def archivePackages(fileIDs, objStrings, client):
+  # find the latest version of each package on the GMN, and those of its
+  # objects not yet archived. the ISO 19139 object is archived first and the
+  # resource map last, so a package whose resource map is archived is complete
+  # and one whose ISO 19139 object is not archived is untouched; a package
+  # archived part way is finished on the next run, skipping archived objects
+  packages = []
+  for fileID in fileIDs:
+    idx = latest_index(fileID, objStrings)
+    if idx < 0:
+      continue
+
+    members = [("iso19139_" + fileID + "_" + str(idx), DATA_FORMAT_ID),
+               ("dcx_"      + fileID + "_" + str(idx), META_FORMAT_ID),
+               (fileID + "_" + str(idx),               RMAP_FORMAT_ID)]
+    pids = []
+    try:
+      sleep(0.1)
+      if client.getSystemMetadata(members[-1][0]).archived:
+        continue
+
+      for pid, formatId in members[:-1]:
+        sleep(0.1)
+        sysMeta = client.getSystemMetadata(pid)
+        if sysMeta.formatId != formatId:
+          print pid + " has format " + sysMeta.formatId + ", not " + formatId + ","
+          print "not a geo2d1 package, skipping " + fileID + "_" + str(idx) + "..."
+          break
+        if not sysMeta.archived:
+          pids.append(pid)
+      else:
+        packages.append((fileID, idx, pids + [members[-1][0]]))
+    except d1_common.types.exceptions.DataONEException as e:
+      print "system metadata retrieval error for package " + fileID + "_" + str(idx) + ":"
+      print e
+      print "skipping..."
+
+  print "archiving " + str(len(packages)) + " packages..."
+
+  # on any failure the rest of the package is left alone and retried on the
+  # next run
+  for fileID, idx, pids in packages:
+    for pid in pids:
+      try:
+        sleep(0.1)
+        client.archive(pid)
+      except d1_common.types.exceptions.DataONEException as e:
+        print "archive of " + pid + " failed with exception:"
+        print e
+        print "package " + fileID + "_" + str(idx) + " will be retried on the next run."
+        break
+      else:
+        print "archive of " + pid + " succeeded"
+
+
+def make_payload(data):
+  # size and SHA-1 are taken once here and reused for both the system
+  # metadata and the upload, rather than recomputed per call
+  return Payload(data, len(data), hashlib.sha1(data).hexdigest())
+
+
+def serialize_payload(node, declaration):
+  # single serialization of an element or tree; et.tostring() keeps its
+  # default ascii encoding (non-ascii as character references) and the
+  # element tail, so the bytes match previously uploaded objects
+  return make_payload(declaration + et.tostring(node))
+
+
+def strip_indent(node, indent):
+  # remove wrapper indentation from the text and tails of node and all of its
+  # descendants (comments included), in place, instead of string replacing
+  # over the serialized document
+  for n in node.iter():
+    if n.text and indent in n.text:
+      n.text = n.text.replace(indent, "\n")
+    if n.tail and indent in n.tail:
+      n.tail = n.tail.replace(indent, "\n")
+
+
 def create_sys_meta(pid, format_id, idx, size, sha1, when):
   sysMeta                         = dataoneTypes.systemMetadata()
   sysMeta.serialVersion           = idx
@@ -597,7 +760,7 @@ def generate_replication_policy():
   return replicationPolicy
 
 
-def updatePackage(dcxString, isoXML, fileID, idx, client):
+def updatePackage(dcx, iso, fileID, idx, client):
   now = datetime.now()
 
   # update metadata object
@@ -607,15 +770,15 @@ def updatePackage(dcxString, isoXML, fileID, idx, client):
               pids[0],
               META_FORMAT_ID,
               idx+1,
-              len(dcxString),
-              dataoneTypes.checksum(hashlib.sha1(dcxString).hexdigest()),
+              dcx.size,
+              dataoneTypes.checksum(dcx.sha1),
               now)
   oldpid  = pids[0] + "_" + str(idx)
   pids[0] = pids[0] + "_" + str(idx+1)
 
   try:
     sleep(0.1)
-    client.update(oldpid, StringIO.StringIO(dcxString), pids[0], sysMeta)
+    client.update(oldpid, cStringIO.StringIO(dcx.data), pids[0], sysMeta)
   except d1_common.types.exceptions.DataONEException as e:
     print "update of " + oldpid + " failed with exception:"
     raise
@@ -629,15 +792,15 @@ def updatePackage(dcxString, isoXML, fileID, idx, client):
               pids[-1],
               DATA_FORMAT_ID,
               idx+1,
-              len(isoXML),
-              dataoneTypes.checksum(hashlib.sha1(isoXML).hexdigest()),
+              iso.size,
+              dataoneTypes.checksum(iso.sha1),
               now)
   oldpid   = pids[-1] + "_" + str(idx)
   pids[-1] = pids[-1] + "_" + str(idx+1)
 
   try:
     sleep(0.1)
-    client.update(oldpid, StringIO.StringIO(isoXML), pids[-1], sysMeta)
+    client.update(oldpid, cStringIO.StringIO(iso.data), pids[-1], sysMeta)
   except d1_common.types.exceptions.DataONEException as e:
     print "manual intervention required due to inconsistent package state:"
     print pids[0] + "has obsoleted dcx_" + fileID + str(idx) + ", but"
@@ -651,18 +814,18 @@ def updatePackage(dcxString, isoXML, fileID, idx, client):
   newpid = fileID + "_" + str(idx+1)
   print "updating: " + oldpid
   rmapGenerator = d1_client.data_package.ResourceMapGenerator()
-  rmap = rmapGenerator.simple_generate_resource_map(newpid, pids[0], pids[1:])
+  rmap = make_payload(rmapGenerator.simple_generate_resource_map(newpid, pids[0], pids[1:]))
   sysMeta = create_sys_meta(
               fileID,
               RMAP_FORMAT_ID,
               idx+1,
-              len(rmap),
-              dataoneTypes.checksum(hashlib.sha1(rmap).hexdigest()),
+              rmap.size,
+              dataoneTypes.checksum(rmap.sha1),
               now)
 
   try:
     sleep(0.1)
-    client.update(oldpid, StringIO.StringIO(rmap), newpid, sysMeta)
+    client.update(oldpid, cStringIO.StringIO(rmap.data), newpid, sysMeta)
   except d1_common.types.exceptions.DataONEException as e:
     print "manual intervention required due to inconsistent package state:"
     print pids[0]  + "has obsoleted dcx_"      + fileID + str(idx) + ", and"